@@ -0,0 +1,334 @@
+"""
+Module for computing per-session analytics from RowPro CSV samples:
+mean-maximal power curve, best efforts over standard distances, split times,
+time in heart rate zones and work per stroke.
+
+The samples are reduced to numeric columns in a single pass, so they can be streamed
+from the file instead of being kept in memory. All calculations run over cumulative
+(prefix sum) columns with sliding windows, so each curve point costs a single linear pass.
+"""
+
+from lxml import etree
+import tcx
+
+
+NS = 'http://www.github.com/piit79/rowpro2tcx/xmlschemas/Analytics/v1'
+NSMAP = {'rp': NS}
+
+# standard durations (seconds) for the mean-maximal power curve
+DURATIONS = [10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+# standard distances (metres) for the best pace curve
+DISTANCES = [100, 500, 1000, 2000, 5000, 6000, 10000]
+# heart rate zone lower bounds as a fraction of the athlete's maximum heart rate
+HR_ZONES = [0.5, 0.6, 0.7, 0.8, 0.9]
+
+
+def sample_columns(samples):
+    """
+    Return the time, distance, work, watts, spm and hr columns of the samples, collected in a single pass.
+    Time, distance and work have a virtual starting point at zero,
+    work is the prefix sum of watts over the sampling intervals, in joules.
+    :type samples: iterable of dict
+    :rtype: dict of list
+    """
+    columns = {'time': [0.0], 'distance': [0.0], 'work': [0.0], 'watts': [], 'spm': [], 'hr': []}
+    times = columns['time']
+    work = columns['work']
+    for sample in samples:
+        dt = sample['time'] - times[-1]
+        times.append(sample['time'])
+        columns['distance'].append(sample['distance'])
+        work.append(work[-1] + (sample['watts'] or 0.0) * dt)
+        columns['watts'].append(sample['watts'])
+        columns['spm'].append(sample['spm'])
+        columns['hr'].append(sample['hr'])
+
+    return columns
+
+
+def best_average(times, totals, span):
+    """
+    Return the best average rate of a cumulative column over any window at least span seconds long
+    :type times: list of float
+    :type totals: list of float
+    :type span: float
+    :rtype: float or None
+    """
+    best = None
+    start = 0
+    for end in xrange(1, len(times)):
+        # shrink the window from the left while it still spans the requested duration
+        while start + 1 < end and times[end] - times[start + 1] >= span:
+            start += 1
+        elapsed = times[end] - times[start]
+        if elapsed < span or elapsed <= 0:
+            continue
+        avg = (totals[end] - totals[start]) / elapsed
+        if best is None or avg > best:
+            best = avg
+
+    return best
+
+
+def best_time(times, distances, distance):
+    """
+    Return the shortest time (seconds) taken to cover the given distance, scaled to the exact distance
+    :type times: list of float
+    :type distances: list of float
+    :type distance: float
+    :rtype: float or None
+    """
+    best = None
+    start = 0
+    for end in xrange(1, len(distances)):
+        while start + 1 < end and distances[end] - distances[start + 1] >= distance:
+            start += 1
+        covered = distances[end] - distances[start]
+        if covered < distance or covered <= 0:
+            continue
+        elapsed = (times[end] - times[start]) * distance / covered
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def power_curve(times, work, durations=DURATIONS):
+    """
+    Return the mean-maximal power for each duration the session is long enough for
+    :type times: list of float
+    :type work: list of float
+    :type durations: list of float
+    :return: list of (duration, watts) tuples
+    :rtype: list of tuple
+    """
+    curve = []
+    for duration in durations:
+        watts = best_average(times, work, duration)
+        if watts is not None:
+            curve.append((duration, watts))
+
+    return curve
+
+
+def pace_curve(times, distances, lengths=DISTANCES):
+    """
+    Return the best time for each distance the session is long enough for
+    :type times: list of float
+    :type distances: list of float
+    :type lengths: list of float
+    :return: list of (distance, seconds) tuples
+    :rtype: list of tuple
+    """
+    curve = []
+    for length in lengths:
+        seconds = best_time(times, distances, length)
+        if seconds is not None:
+            curve.append((length, seconds))
+
+    return curve
+
+
+def splits(times, distances, split_distance=500.0):
+    """
+    Return split times, interpolating the moment each split boundary was crossed.
+    The last split may be shorter than split_distance.
+    :type times: list of float
+    :type distances: list of float
+    :type split_distance: float
+    :return: list of dicts with distance, elapsed and time keys
+    :rtype: list of dict
+    """
+    result = []
+    boundary = split_distance
+    last_elapsed = 0.0
+    last_distance = 0.0
+    for i in xrange(1, len(distances)):
+        while distances[i] >= boundary > distances[i - 1]:
+            ratio = (boundary - distances[i - 1]) / (distances[i] - distances[i - 1])
+            elapsed = times[i - 1] + ratio * (times[i] - times[i - 1])
+            result.append({'distance': boundary, 'elapsed': elapsed, 'time': elapsed - last_elapsed})
+            last_elapsed = elapsed
+            last_distance = boundary
+            boundary += split_distance
+
+    if len(distances) > 1 and distances[-1] > last_distance:
+        result.append({'distance': distances[-1], 'elapsed': times[-1], 'time': times[-1] - last_elapsed})
+
+    return result
+
+
+def hr_zone_times(times, heart_rates, max_hr, zones=HR_ZONES):
+    """
+    Return the time (seconds) spent in each heart rate zone.
+    Samples without a heart rate reading (0 or None) are not counted.
+    :param times: sample times with a virtual starting point at zero
+    :type times: list of float
+    :type heart_rates: list of int
+    :param max_hr: the athlete's maximum heart rate the zones are relative to
+    :type max_hr: int
+    :type zones: list of float
+    :rtype: list of float
+    """
+    totals = [0.0] * len(zones)
+
+    bounds = [zone * max_hr for zone in zones]
+    for i, hr in enumerate(heart_rates):
+        dt = times[i + 1] - times[i]
+        if not hr or hr < bounds[0]:
+            continue
+        zone = len(bounds) - 1
+        while hr < bounds[zone]:
+            zone -= 1
+        totals[zone] += dt
+
+    return totals
+
+
+def work_per_stroke(watts, spms):
+    """
+    Return work per stroke (joules) for each sample, None where the stroke rate is unknown
+    :type watts: list of float
+    :type spms: list of int
+    :rtype: list of float
+    """
+    return [pwr * 60.0 / spm if spm else None for pwr, spm in zip(watts, spms)]
+
+
+class SessionAnalytics(object):
+    """
+    :type power_curve: list of tuple
+    :type pace_curve: list of tuple
+    :type splits: list of dict
+    :type max_hr: int
+    :type hr_zone_times: list of float or None
+    :type work_per_stroke: list of float
+    :type avg_work_per_stroke: float
+    """
+    power_curve = None
+    pace_curve = None
+    splits = None
+    hr_zones = None
+    max_hr = None
+    hr_zone_times = None
+    work_per_stroke = None
+    avg_work_per_stroke = None
+
+    def __init__(self, samples, durations=DURATIONS, distances=DISTANCES, split_distance=500.0,
+                 hr_zones=HR_ZONES, max_hr=None):
+        """
+        :param samples: samples, iterated only once so they can be streamed from the file
+        :type samples: iterable of dict
+        :type durations: list of float
+        :type distances: list of float
+        :type split_distance: float
+        :type hr_zones: list of float
+        :param max_hr: the athlete's maximum heart rate, the heart rate zones are only computed if it is given
+        :type max_hr: int
+        """
+        columns = sample_columns(samples)
+        times = columns['time']
+        work = columns['work']
+        self.power_curve = power_curve(times, work, durations)
+        self.pace_curve = pace_curve(times, columns['distance'], distances)
+        self.splits = splits(times, columns['distance'], split_distance)
+        self.hr_zones = hr_zones
+        self.max_hr = max_hr
+        if max_hr:
+            # zones relative to the session's own peak would always put its hardest part in the top zone
+            self.hr_zone_times = hr_zone_times(times, columns['hr'], max_hr, hr_zones)
+        self.work_per_stroke = work_per_stroke(columns['watts'], columns['spm'])
+
+        # average work per stroke is total work divided by the total number of strokes
+        strokes = 0.0
+        for i, spm in enumerate(columns['spm']):
+            strokes += (spm or 0) * (times[i + 1] - times[i]) / 60.0
+        if strokes > 0:
+            self.avg_work_per_stroke = work[-1] / strokes
+
+    def get_lap_extension(self):
+        """
+        Return the extension holding the lap level analytics
+        :rtype: LapAnalytics
+        """
+        return LapAnalytics(self)
+
+    def get_activity_extension(self):
+        """
+        Return the extension holding the activity level analytics
+        :rtype: ActivityAnalytics
+        """
+        return ActivityAnalytics(self)
+
+
+class LapAnalytics(tcx.TCXBase):
+    """
+    :type analytics: SessionAnalytics
+    """
+    EXTRA_NSMAP = NSMAP
+    analytics = None
+
+    def __init__(self, analytics):
+        super(LapAnalytics, self).__init__()
+        self.analytics = analytics
+
+    def get_xml(self, profile=None):
+        """
+        Return an XML representation of the instance
+        :type profile: tcx.OutputProfile
+        :return: etree.Element
+        """
+        root = etree.Element('{{{}}}LapStats'.format(NS), nsmap=NSMAP)
+        if self.analytics.avg_work_per_stroke is not None:
+            etree.SubElement(root, '{{{}}}AvgWorkPerStroke'.format(NS)).text = \
+                tcx.format_field(profile, 'work', self.analytics.avg_work_per_stroke)
+
+        splits_el = etree.SubElement(root, '{{{}}}Splits'.format(NS))
+        for split in self.analytics.splits:
+            split_el = etree.SubElement(splits_el, '{{{}}}Split'.format(NS))
+            split_el.attrib['DistanceMeters'] = tcx.format_field(profile, 'distance', split['distance'])
+            split_el.attrib['ElapsedSeconds'] = tcx.format_field(profile, 'total_time', split['elapsed'])
+            split_el.text = tcx.format_field(profile, 'total_time', split['time'])
+
+        if self.analytics.hr_zone_times is not None:
+            zones_el = etree.SubElement(root, '{{{}}}HeartRateZones'.format(NS))
+            zones_el.attrib['MaxHeartRate'] = str(self.analytics.max_hr)
+            for zone, seconds in zip(self.analytics.hr_zones, self.analytics.hr_zone_times):
+                zone_el = etree.SubElement(zones_el, '{{{}}}Zone'.format(NS))
+                zone_el.attrib['MinFraction'] = str(zone)
+                zone_el.text = tcx.format_field(profile, 'total_time', seconds)
+
+        return root
+
+
+class ActivityAnalytics(tcx.TCXBase):
+    """
+    :type analytics: SessionAnalytics
+    """
+    EXTRA_NSMAP = NSMAP
+    analytics = None
+
+    def __init__(self, analytics):
+        super(ActivityAnalytics, self).__init__()
+        self.analytics = analytics
+
+    def get_xml(self, profile=None):
+        """
+        Return an XML representation of the instance
+        :type profile: tcx.OutputProfile
+        :return: etree.Element
+        """
+        root = etree.Element('{{{}}}SessionStats'.format(NS), nsmap=NSMAP)
+        power_el = etree.SubElement(root, '{{{}}}PowerCurve'.format(NS))
+        for duration, watts in self.analytics.power_curve:
+            point_el = etree.SubElement(power_el, '{{{}}}Watts'.format(NS))
+            point_el.attrib['Seconds'] = str(duration)
+            point_el.text = tcx.format_field(profile, 'power', watts)
+
+        pace_el = etree.SubElement(root, '{{{}}}PaceCurve'.format(NS))
+        for distance, seconds in self.analytics.pace_curve:
+            point_el = etree.SubElement(pace_el, '{{{}}}Seconds'.format(NS))
+            point_el.attrib['DistanceMeters'] = str(distance)
+            point_el.text = tcx.format_field(profile, 'total_time', seconds)
+
+        return root
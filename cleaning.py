@@ -0,0 +1,179 @@
+"""
+Module for cleaning RowPro CSV samples before conversion: detecting dropouts and
+outliers, interpolating over them and deriving pace from distance where it is missing.
+
+Each field is processed as a column in a single pass over the session.
+"""
+
+
+# per-field cleaning settings:
+#   min, max: values outside the range are treated as dropouts
+#   max_jump: a single sample differing from both neighbours by more than this in the same direction is an outlier
+#   rest_zero: a value of 0 is valid while resting, i.e. while the distance does not change
+#   derive: derive pace from the distance deltas instead of interpolating (pace only)
+#   max_gap: gaps longer than this (seconds) are not repaired and keep their original values
+#   integer: round the repaired values to int
+DEFAULT_CONFIG = {
+    'pace': {'min': 0.05, 'max': 0.6, 'rest_zero': True, 'derive': True, 'max_gap': 10},   # km/min, ~0.8 - 10 m/s
+    'hr': {'min': 30, 'max': 230, 'max_jump': 40, 'max_gap': 30, 'integer': True},
+    'watts': {'min': 0, 'max': 2000, 'max_jump': 500, 'max_gap': 10},
+    'spm': {'min': 1, 'max': 70, 'rest_zero': True, 'max_gap': 10, 'integer': True},
+}
+
+
+def find_resting(distances):
+    """
+    Return a list of flags marking the samples where the distance did not change since the previous sample
+    :type distances: list of float
+    :rtype: list of bool
+    """
+    resting = []
+    prev_distance = 0.0
+    for distance in distances:
+        resting.append(distance is not None and distance == prev_distance)
+        if distance is not None:
+            prev_distance = distance
+
+    return resting
+
+
+def find_invalid(values, settings, resting=None):
+    """
+    Return a list of flags marking the values that are dropouts or outliers
+    :type values: list of float
+    :type settings: dict
+    :param resting: flags of the resting samples, see find_resting()
+    :type resting: list of bool
+    :rtype: list of bool
+    """
+    low = settings.get('min')
+    high = settings.get('max')
+    invalid = [val is None or (low is not None and val < low) or (high is not None and val > high)
+               for val in values]
+    if settings.get('rest_zero') and resting is not None:
+        for i, val in enumerate(values):
+            if invalid[i] and val == 0 and resting[i]:
+                invalid[i] = False
+
+    max_jump = settings.get('max_jump')
+    if max_jump is not None:
+        for i in xrange(1, len(values) - 1):
+            if invalid[i] or invalid[i - 1] or invalid[i + 1]:
+                continue
+            before = values[i] - values[i - 1]
+            after = values[i] - values[i + 1]
+            if (before > max_jump and after > max_jump) or (before < -max_jump and after < -max_jump):
+                invalid[i] = True
+
+    return invalid
+
+
+def interpolate(times, values, invalid, max_gap=None):
+    """
+    Return the values with the invalid ones linearly interpolated in time between the nearest valid neighbours.
+    Invalid values before the first or after the last valid one take the nearest valid value.
+    Gaps spanning more than max_gap seconds keep their original values.
+    :type times: list of float
+    :type values: list of float
+    :type invalid: list of bool
+    :type max_gap: float
+    :rtype: list of float
+    """
+    result = list(values)
+    last = None
+    for i in xrange(len(values)):
+        if invalid[i]:
+            continue
+        if last is None:
+            # leading gap
+            if i > 0 and (max_gap is None or times[i] - times[0] <= max_gap):
+                for j in xrange(i):
+                    result[j] = values[i]
+        elif i - last > 1:
+            span = times[i] - times[last]
+            if max_gap is None or span <= max_gap:
+                for j in xrange(last + 1, i):
+                    ratio = (times[j] - times[last]) / span if span > 0 else 0.0
+                    result[j] = values[last] + ratio * (values[i] - values[last])
+        last = i
+
+    if last is not None and last < len(values) - 1:
+        # trailing gap
+        if max_gap is None or times[-1] - times[last] <= max_gap:
+            for j in xrange(last + 1, len(values)):
+                result[j] = values[last]
+
+    return result
+
+
+def derive_pace(times, distances, values, invalid):
+    """
+    Return the pace values (kilometres per minute) with the invalid ones derived from the distance deltas,
+    and the flags of the values that could not be derived. Derived values are kept as they are,
+    including 0 while resting.
+    :type times: list of float
+    :type distances: list of float
+    :type values: list of float
+    :type invalid: list of bool
+    :rtype: tuple of (list of float, list of bool)
+    """
+    result = list(values)
+    underived = list(invalid)
+    prev_time = 0.0
+    prev_distance = 0.0
+    for i in xrange(len(values)):
+        dt = times[i] - prev_time
+        if invalid[i] and dt > 0 and distances[i] is not None:
+            # metres per second -> kilometres per minute
+            result[i] = (distances[i] - prev_distance) / dt * 60.0 / 1000.0
+            underived[i] = False
+        prev_time = times[i]
+        if distances[i] is not None:
+            prev_distance = distances[i]
+
+    return result, underived
+
+
+def clean_samples(samples, config=None):
+    """
+    Return copies of the samples with dropouts and outliers repaired.
+    The config maps field names to settings merged into the field's DEFAULT_CONFIG settings,
+    None disables a field.
+    :type samples: list of dict
+    :type config: dict
+    :rtype: list of dict
+    """
+    settings = dict(DEFAULT_CONFIG)
+    if config is not None:
+        for field, override in config.items():
+            settings[field] = None if override is None else dict(DEFAULT_CONFIG.get(field, {}), **override)
+
+    times = [sample['time'] for sample in samples]
+    distances = [sample['distance'] for sample in samples]
+    resting = find_resting(distances)
+    columns = {}
+    for field, field_settings in settings.items():
+        if field_settings is None:
+            continue
+
+        values = [sample.get(field) for sample in samples]
+        invalid = find_invalid(values, field_settings, resting)
+        if not any(invalid):
+            continue
+
+        if field_settings.get('derive'):
+            # fall back to interpolation only where the distance did not help
+            values, invalid = derive_pace(times, distances, values, invalid)
+        values = interpolate(times, values, invalid, field_settings.get('max_gap'))
+        if field_settings.get('integer'):
+            values = [int(round(val)) if val is not None else None for val in values]
+        columns[field] = values
+
+    cleaned = []
+    for i, sample in enumerate(samples):
+        sample = dict(sample)
+        for field, values in columns.items():
+            sample[field] = values[i]
+        cleaned.append(sample)
+
+    return cleaned
@@ -0,0 +1,190 @@
+"""
+Module for finding duplicate RowPro sessions across a batch of exports, including copies
+with re-trimmed ends, so they can be skipped before conversion and upload.
+
+Each session is reduced to a fingerprint: an exact digest of its summary and samples and a
+sketch of rolling hashes over the (time, distance, watts) sample stream. Candidate pairs are
+found through an inverted index over the sketches, so a batch is processed in roughly linear time.
+"""
+
+import hashlib
+
+
+# number of consecutive samples hashed together
+SHINGLE_SIZE = 8
+# one in this many shingle hashes is kept in the sketch
+SAMPLE_RATE = 8
+# token resolution of the time step (milliseconds) and the distance step (micrometres)
+TIME_BUCKET = 10
+DISTANCE_BUCKET = 100000
+# minimum fraction of the smaller sketch shared with the larger one for a near duplicate
+THRESHOLD = 0.8
+
+HASH_BASE = 1000003
+HASH_MOD = (1 << 61) - 1
+
+
+def sample_token(dt, step):
+    """
+    Return an integer token for a sample, built from values that do not depend on where the session starts
+    :param dt: time step in TIME_BUCKET units
+    :type dt: int
+    :param step: distance step in DISTANCE_BUCKET units and the power rounded to 1 W
+    :type step: tuple of (int, int)
+    :rtype: int
+    """
+    return hash((dt, ) + step) & 0xffffffff
+
+
+def mix(value):
+    """
+    Scramble the bits of a hash so that sampling by modulo picks shingles uniformly
+    :type value: int
+    :rtype: int
+    """
+    value = (value ^ (value >> 31)) * 0x7fb5d329728ea185 & 0xffffffffffffffff
+    value = (value ^ (value >> 27)) * 0x81dadef4bc2dd44d & 0xffffffffffffffff
+    return value ^ (value >> 33)
+
+
+class SessionFingerprint(object):
+    """
+    :type key: str
+    :type summary: tuple
+    :type digest: str
+    :type sketch: set of int
+    :type num_samples: int
+    """
+    key = None
+    summary = None
+    digest = None
+    sketch = None
+    num_samples = 0
+
+    def __init__(self, rowpro, key=None, chunk_size=1000):
+        """
+        :type rowpro: rowprocsv.RowProCSV
+        :param key: identifier of the session in the results, the file name by default
+        :type key: str
+        :type chunk_size: int
+        """
+        self.key = key if key is not None else rowpro.filename
+        self.summary = (rowpro.date.isoformat() if rowpro.date is not None else None,
+                        rowpro.total_time, rowpro.total_distance)
+        self.sketch = set()
+        self.num_samples = 0
+
+        digest = hashlib.sha1(repr(self.summary))
+        window = []
+        shingle = 0
+        # weight of the token leaving the window
+        top = pow(HASH_BASE, SHINGLE_SIZE - 1, HASH_MOD)
+        prev_time = 0
+        prev_distance = 0
+        for chunk in rowpro.iter_samples(chunk_size):
+            for sample in chunk:
+                # steps are taken between whole milliseconds and micrometres (the precision of the CSV)
+                # and bucketed afterwards, so they don't depend on float noise in the absolute values
+                time_ms = int(round(sample['time'] * 1000))
+                distance_um = int(round(sample['distance'] * 1000000))
+                dt = (time_ms - prev_time) // TIME_BUCKET
+                step = ((distance_um - prev_distance) // DISTANCE_BUCKET, int(round(sample['watts'] or 0)))
+                prev_time = time_ms
+                prev_distance = distance_um
+                digest.update(repr((sample['time'], sample['distance'], sample['watts'])))
+                self.num_samples += 1
+
+                if not step[0]:
+                    # idle samples look the same in every session, don't let shingles span them
+                    window = []
+                    shingle = 0
+                    continue
+                token = sample_token(dt, step)
+
+                # Rabin-Karp rolling hash over the last SHINGLE_SIZE tokens
+                if len(window) == SHINGLE_SIZE:
+                    shingle = (shingle - window.pop(0) * top) % HASH_MOD
+                window.append(token)
+                shingle = (shingle * HASH_BASE + token) % HASH_MOD
+                if len(window) == SHINGLE_SIZE:
+                    value = mix(shingle)
+                    if value % SAMPLE_RATE == 0:
+                        self.sketch.add(value)
+
+        self.digest = digest.hexdigest()
+
+    def similarity(self, other):
+        """
+        Return the estimated fraction of the smaller session contained in the larger one
+        :type other: SessionFingerprint
+        :rtype: float
+        """
+        if self.digest == other.digest:
+            return 1.0
+        size = min(len(self.sketch), len(other.sketch))
+        if not size:
+            return 0.0
+        return len(self.sketch & other.sketch) / float(size)
+
+
+def find_duplicates(fingerprints, threshold=THRESHOLD):
+    """
+    Return the pairs of duplicate sessions, each pair as (duplicate, original, similarity)
+    where the original is the longer session (the earlier one for exact duplicates)
+    :type fingerprints: list of SessionFingerprint
+    :type threshold: float
+    :rtype: list of tuple
+    """
+    pairs = []
+    by_digest = {}
+    index = {}
+    for fp in fingerprints:
+        original = by_digest.get(fp.digest)
+        if original is not None:
+            pairs.append((fp, original, 1.0))
+            continue
+        by_digest[fp.digest] = fp
+
+        # count the sketch hashes shared with each earlier session
+        shared = {}
+        for value in fp.sketch:
+            for other in index.get(value, ()):
+                shared[other] = shared.get(other, 0) + 1
+            index.setdefault(value, []).append(fp)
+
+        for other, count in shared.items():
+            similarity = count / float(min(len(fp.sketch), len(other.sketch)))
+            if similarity >= threshold:
+                if fp.num_samples > other.num_samples:
+                    pairs.append((other, fp, similarity))
+                else:
+                    pairs.append((fp, other, similarity))
+
+    return pairs
+
+
+def select_unique(fingerprints, threshold=THRESHOLD):
+    """
+    Return the keys of the sessions to convert, keeping only the longest session of each group of duplicates
+    :type fingerprints: list of SessionFingerprint
+    :type threshold: float
+    :rtype: list of str
+    """
+    # union-find over the duplicate pairs, the root of each group is its longest session
+    parent = {}
+
+    def find(fp):
+        while parent.get(fp, fp) is not fp:
+            fp = parent[fp]
+        return fp
+
+    for duplicate, original, similarity in find_duplicates(fingerprints, threshold):
+        dup_root = find(duplicate)
+        orig_root = find(original)
+        if dup_root is orig_root:
+            continue
+        if dup_root.num_samples > orig_root.num_samples:
+            dup_root, orig_root = orig_root, dup_root
+        parent[dup_root] = orig_root
+
+    return [fp.key for fp in fingerprints if find(fp) is fp]
@@ -0,0 +1,214 @@
+"""
+Module for keeping a persistent SQLite index of RowPro CSV session summaries,
+so sessions can be queried and selected for conversion without reparsing the files.
+"""
+
+import hashlib
+import os
+import sqlite3
+import dateutil.parser
+import dateutil.tz
+import rowprocsv
+
+
+def normalize_date(dt):
+    """
+    Return the datetime as a naive local time, the form RowPro session dates are stored in,
+    so dates can be compared as ISO 8601 strings
+    :type dt: datetime.datetime
+    :rtype: datetime.datetime
+    """
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(dateutil.tz.tzlocal()).replace(tzinfo=None)
+    return dt
+
+
+class HistoryIndex(object):
+    """
+    :type filename: str
+    :type conn: sqlite3.Connection
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS sessions ('
+        ' path TEXT PRIMARY KEY,'
+        ' mtime REAL NOT NULL,'
+        ' size INTEGER NOT NULL,'
+        ' sha1 TEXT NOT NULL,'
+        ' date TEXT,'
+        ' total_time REAL,'
+        ' total_distance REAL,'
+        ' avg_pace REAL,'
+        ' total_cals REAL,'
+        ' avg_hr INTEGER'
+        ')',
+        'CREATE INDEX IF NOT EXISTS sessions_date ON sessions (date)',
+        'CREATE INDEX IF NOT EXISTS sessions_sha1 ON sessions (sha1)',
+    )
+    FIELDS = ['path', 'date', 'total_time', 'total_distance', 'avg_pace', 'total_cals', 'avg_hr']
+    SUMMARY_FIELDS = FIELDS[1:]
+
+    filename = None
+    conn = None
+
+    def __init__(self, filename):
+        """
+        :param filename: SQLite database file, created if it does not exist
+        :type filename: str
+        """
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self.conn.close()
+
+    @staticmethod
+    def fingerprint(path):
+        """
+        Return the SHA-1 hex digest of the file contents
+        :type path: str
+        :rtype: str
+        """
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(65536), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def update(self, paths):
+        """
+        Add new files to the index and reindex the changed ones.
+        Files whose modification time and size match the index are not read at all,
+        files with the contents of an indexed file (e.g. renamed or moved) reuse its summary.
+        :type paths: list of str
+        :return: number of files (re)indexed
+        :rtype: int
+        """
+        known = dict(((row[0], (row[1], row[2], row[3]))
+                      for row in self.conn.execute('SELECT path, mtime, size, sha1 FROM sessions')))
+        indexed = 0
+        with self.conn:
+            for path in paths:
+                path = os.path.abspath(path)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    print 'Could not stat file {}: {}'.format(path, e)
+                    continue
+
+                entry = known.get(path)
+                if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+                    continue
+
+                sha1 = self.fingerprint(path)
+                if entry is not None and entry[2] == sha1:
+                    # touched but not changed, just refresh the stat data
+                    self.conn.execute('UPDATE sessions SET mtime = ?, size = ? WHERE path = ?',
+                                      (st.st_mtime, st.st_size, path))
+                    continue
+
+                # only the summary is indexed, don't parse the samples
+                summary = self.conn.execute(
+                    'SELECT {} FROM sessions WHERE sha1 = ? AND path != ? LIMIT 1'.format(
+                        ', '.join(self.SUMMARY_FIELDS)), (sha1, path)).fetchone()
+                if summary is None:
+                    rp = rowprocsv.RowProCSV(path, load_samples=False)
+                    date = normalize_date(rp.date)
+                    summary = (date.isoformat() if date is not None else None,
+                               rp.total_time, rp.total_distance, rp.avg_pace, rp.total_cals, rp.avg_hr)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO sessions (path, mtime, size, sha1, date, total_time, total_distance,'
+                    ' avg_pace, total_cals, avg_hr) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, st.st_mtime, st.st_size, sha1) + tuple(summary))
+                indexed += 1
+
+        return indexed
+
+    def update_dir(self, directory, extension='.csv'):
+        """
+        Index all files with the given extension under a directory (recursively)
+        :type directory: str
+        :type extension: str
+        :return: number of files (re)indexed
+        :rtype: int
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                if name.lower().endswith(extension):
+                    paths.append(os.path.join(dirpath, name))
+
+        return self.update(paths)
+
+    def prune(self):
+        """
+        Remove index entries of files that no longer exist
+        :return: number of entries removed
+        :rtype: int
+        """
+        missing = [(row[0],) for row in self.conn.execute('SELECT path FROM sessions')
+                   if not os.path.exists(row[0])]
+        with self.conn:
+            self.conn.executemany('DELETE FROM sessions WHERE path = ?', missing)
+
+        return len(missing)
+
+    def query(self, date_from=None, date_to=None, min_distance=None, max_distance=None,
+              min_time=None, max_time=None):
+        """
+        Return summaries of the indexed sessions matching all given criteria, ordered by date
+        :param date_from: earliest session start (inclusive), timezone aware dates are converted to local time
+        :type date_from: datetime.datetime
+        :param date_to: latest session start (exclusive), timezone aware dates are converted to local time
+        :type date_to: datetime.datetime
+        :type min_distance: float
+        :type max_distance: float
+        :param min_time: minimum total time in seconds
+        :type min_time: float
+        :param max_time: maximum total time in seconds
+        :type max_time: float
+        :rtype: list of dict
+        """
+        date_from = normalize_date(date_from)
+        date_to = normalize_date(date_to)
+        conditions = []
+        params = []
+        for column, operator, value in [
+            ('date', '>=', date_from.isoformat() if date_from is not None else None),
+            ('date', '<', date_to.isoformat() if date_to is not None else None),
+            ('total_distance', '>=', min_distance),
+            ('total_distance', '<=', max_distance),
+            ('total_time', '>=', min_time),
+            ('total_time', '<=', max_time),
+        ]:
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                params.append(value)
+
+        sql = 'SELECT {} FROM sessions'.format(', '.join(self.FIELDS))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date'
+
+        sessions = []
+        for row in self.conn.execute(sql, params):
+            session = dict(zip(self.FIELDS, row))
+            if session['date'] is not None:
+                session['date'] = dateutil.parser.parse(session['date'])
+            sessions.append(session)
+
+        return sessions
+
+    def select_paths(self, **kwargs):
+        """
+        Return the paths of sessions matching the criteria, e.g. to select a batch for conversion
+        Keyword arguments are the same as for query()
+        :rtype: list of str
+        """
+        return [session['path'] for session in self.query(**kwargs)]
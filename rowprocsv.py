@@ -4,7 +4,10 @@ See https://www.digitalrowing.com/
 """
 
 import datetime
+import mmap
 import dateutil.parser
+import analytics
+import cleaning
 import tcx
 
 
@@ -61,10 +64,13 @@ class RowProCSV:
     :type total_cals: int
     :type slide: bool
     :type avg_hr: int
-    :type samples: list of dict
+    :type samples: list of dict or None
+    :type filename: str
     """
 
     CREATOR = 'DigitalRowing RowPro'
+    LINE_SEP = '\r\n'
+    WHITESPACE = ' \t\r\n\x0b\x0c'
 
     HEADER_SUMMARY = 'Date,TotalTime,TotalDistance,AvgPace,Unit,Origin,TotalCals,DutyCycle,Type,Format,Slide,AvgHR,'
     FIELDS_SUMMARY = [
@@ -106,16 +112,71 @@ class RowProCSV:
     slide = False
     avg_hr = None
     samples = []
+    filename = None
 
-    def __init__(self, filename, rowpro_version=None):
+    def __init__(self, filename, rowpro_version=None, use_mmap=False, load_samples=True):
         """
         :type filename: str
+        :param use_mmap: read the file through mmap and parse the samples straight from the mapped bytes,
+            faster than the default loader for long sessions
+        :type use_mmap: bool
+        :param load_samples: load the samples into memory, otherwise only the summary is read
+            and the samples are read from the file by iter_samples() when needed
+        :type load_samples: bool
         """
         self.rowpro_version = rowpro_version
+        self.filename = filename
+        # per-instance list, the class attribute would be shared by all parsed files
+        self.samples = []
+        if not load_samples:
+            self.samples = None
+            summary_found, samples_found = self.load_summary(filename)
+        elif use_mmap:
+            summary_found, samples_found = self.load_mmap(filename)
+        else:
+            summary_found, samples_found = self.load_text(filename)
+
+        if not summary_found:
+            print 'Warning: summary section not found in file'
+        if not samples_found:
+            print 'Warning: samples section not found in file'
+
+    def parse_summary(self, line):
+        """
+        Set the summary fields from the summary data line
+        :type line: str
+        """
+        summary_data = line.split(',')
+        if len(summary_data) < len(self.FIELDS_SUMMARY):
+            print 'Warning: summary line only has {} fields, {} expected'.format(len(summary_data),
+                                                                                 len(self.FIELDS_SUMMARY))
+        for field, field_type in self.FIELDS_SUMMARY:
+            # skip fields we don't need
+            if hasattr(self, field) is None:
+                continue
+
+            val = summary_data.pop(0) if len(summary_data) else None
+
+            if field_type is not None and val is not None:
+                # convert the field using the specified function
+                try:
+                    val = field_type(val)
+                except ValueError:
+                    print 'Error converting field {} value "{}" to {}'.format(field, val, str(field_type))
+
+            setattr(self, field, val)
+
+    def load_text(self, filename):
+        """
+        Read the file into memory and parse it line by line
+        :type filename: str
+        :return: whether the summary and the samples sections were found
+        :rtype: tuple of (bool, bool)
+        """
         lines = []
         try:
             with open(filename, 'r') as fp:
-                lines = fp.read().split("\r\n")
+                lines = fp.read().split(self.LINE_SEP)
         except IOError as e:
             print 'Could not read file {}: {}'.format(filename, e)
 
@@ -127,27 +188,7 @@ class RowProCSV:
                 continue
 
             if line.startswith(self.HEADER_SUMMARY):
-                line = lines.pop(0)
-                summary_data = line.split(',')
-                if len(summary_data) < len(self.FIELDS_SUMMARY):
-                    print 'Warning: summary line only has {} fields, {} expected'.format(len(summary_data),
-                                                                                         len(self.FIELDS_SUMMARY))
-                for field, field_type in self.FIELDS_SUMMARY:
-                    # skip fields we don't need
-                    if hasattr(self, field) is None:
-                        continue
-
-                    val = summary_data.pop(0) if len(summary_data) else None
-
-                    if field_type is not None and val is not None:
-                        # convert the field using the specified function
-                        try:
-                            val = field_type(val)
-                        except ValueError:
-                            print 'Error converting field {} value "{}" to {}'.format(field, val, str(field_type))
-
-                    setattr(self, field, val)
-
+                self.parse_summary(lines.pop(0))
                 summary_found = True
                 continue
 
@@ -157,30 +198,191 @@ class RowProCSV:
                     if not line:
                         break
 
-                    sample_data = line.split(',')
+                    self.samples.append(self.parse_sample(line))
+                    samples_found = True
 
-                    sample = {}
-                    for field, field_type in self.FIELDS_SAMPLES:
-                        val = sample_data.pop(0) if len(sample_data) else None
+                break
 
-                        if field_type is not None and val is not None:
-                            # convert time from milliseconds to fractional seconds
-                            try:
-                                val = field_type(val)
-                            except ValueError:
-                                print 'Error converting field {} value "{}" to {}'.format(field, val, str(field_type))
+        return summary_found, samples_found
 
-                        sample[field] = val
+    def parse_sample(self, line):
+        """
+        Return a sample parsed from a sample data line
+        :type line: str
+        :rtype: dict
+        """
+        sample_data = line.split(',')
 
-                    self.samples.append(sample)
-                    samples_found = True
+        sample = {}
+        for field, field_type in self.FIELDS_SAMPLES:
+            val = sample_data.pop(0) if len(sample_data) else None
 
-                break
+            if field_type is not None and val is not None:
+                # convert time from milliseconds to fractional seconds
+                try:
+                    val = field_type(val)
+                except ValueError:
+                    print 'Error converting field {} value "{}" to {}'.format(field, val, str(field_type))
 
-        if not summary_found:
-            print 'Warning: summary section not found in file'
-        if not samples_found:
-            print 'Warning: samples section not found in file'
+            sample[field] = val
+
+        return sample
+
+    def load_summary(self, filename):
+        """
+        Read the file line by line up to the samples header, parsing only the summary
+        :type filename: str
+        :return: whether the summary and the samples sections were found
+        :rtype: tuple of (bool, bool)
+        """
+        summary_found = False
+        try:
+            with open(filename, 'r') as fp:
+                for line in fp:
+                    if line.startswith(self.HEADER_SUMMARY):
+                        self.parse_summary(next(fp, '').rstrip(self.LINE_SEP))
+                        summary_found = True
+                    elif line.startswith(self.HEADER_SAMPLES):
+                        return summary_found, True
+        except IOError as e:
+            print 'Could not read file {}: {}'.format(filename, e)
+
+        return summary_found, False
+
+    def iter_samples(self, chunk_size=1000):
+        """
+        Yield the samples in lists of at most chunk_size samples.
+        If the samples were not loaded, they are read from the file lazily, so memory use
+        does not depend on the length of the session.
+        :type chunk_size: int
+        :rtype: generator of list of dict
+        """
+        if self.samples is not None:
+            for i in xrange(0, len(self.samples), chunk_size):
+                yield self.samples[i:i + chunk_size]
+            return
+
+        chunk = []
+        try:
+            with open(self.filename, 'r') as fp:
+                for line in fp:
+                    if line.startswith(self.HEADER_SAMPLES):
+                        break
+                for line in fp:
+                    line = line.strip()
+                    if not line:
+                        break
+
+                    chunk.append(self.parse_sample(line))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+        except IOError as e:
+            print 'Could not read file {}: {}'.format(self.filename, e)
+
+        if chunk:
+            yield chunk
+
+    def iter_trackpoints(self, chunk_size=1000):
+        """
+        Yield TCX Trackpoint instances created from the samples one by one
+        :type chunk_size: int
+        :rtype: generator of tcx.Trackpoint
+        """
+        for chunk in self.iter_samples(chunk_size):
+            for sample in chunk:
+                yield self.sample_to_trackpoint(self.date, sample)
+
+    @classmethod
+    def find_header(cls, buf, header, start=0):
+        """
+        Return the offset of the first line following the given header line, -1 if not found
+        :type buf: mmap.mmap
+        :type header: str
+        :type start: int
+        :rtype: int
+        """
+        pos = buf.find(header, start)
+        # the header must start a line
+        while pos > 0 and buf[pos - 1] != '\n':
+            pos = buf.find(header, pos + 1)
+        if pos < 0:
+            return -1
+
+        line_end = buf.find(cls.LINE_SEP, pos)
+        return line_end + len(cls.LINE_SEP) if line_end >= 0 else len(buf)
+
+    def load_mmap(self, filename):
+        """
+        Map the file into memory and parse the samples field by field straight from the mapped buffer,
+        without reading the whole file into a string and keeping a list of its lines.
+        Gives the same results as load_text() for files with CRLF line endings.
+        This is faster than load_text() but does not use less memory: the loaded sample dicts dominate
+        the memory use of both loaders and the mapped pages count towards the resident size.
+        Use load_samples=False to keep the memory use independent of the session length.
+        :type filename: str
+        :return: whether the summary and the samples sections were found
+        :rtype: tuple of (bool, bool)
+        """
+        summary_found = False
+        samples_found = False
+        try:
+            with open(filename, 'rb') as fp:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError, mmap.error) as e:
+            print 'Could not read file {}: {}'.format(filename, e)
+            return summary_found, samples_found
+
+        try:
+            size = len(buf)
+            sep_len = len(self.LINE_SEP)
+            pos = self.find_header(buf, self.HEADER_SUMMARY)
+            if pos >= 0:
+                line_end = buf.find(self.LINE_SEP, pos)
+                self.parse_summary(buf[pos:line_end if line_end >= 0 else size])
+                summary_found = True
+
+            pos = self.find_header(buf, self.HEADER_SAMPLES)
+            while 0 <= pos < size:
+                next_line = buf.find(self.LINE_SEP, pos)
+                if next_line < 0:
+                    next_line = size
+                # skip the surrounding whitespace like load_text() does with strip()
+                line_end = next_line
+                while line_end > pos and buf[line_end - 1] in self.WHITESPACE:
+                    line_end -= 1
+                while pos < line_end and buf[pos] in self.WHITESPACE:
+                    pos += 1
+                if line_end == pos:
+                    break
+
+                sample = {}
+                field_start = pos
+                for field, field_type in self.FIELDS_SAMPLES:
+                    if field_start > line_end:
+                        sample[field] = None
+                        continue
+                    field_end = buf.find(',', field_start, line_end)
+                    if field_end < 0:
+                        field_end = line_end
+
+                    val = buf[field_start:field_end]
+                    if field_type is not None:
+                        try:
+                            val = field_type(val)
+                        except ValueError:
+                            print 'Error converting field {} value "{}" to {}'.format(field, val, str(field_type))
+
+                    sample[field] = val
+                    field_start = field_end + 1
+
+                self.samples.append(sample)
+                samples_found = True
+                pos = next_line + sep_len
+        finally:
+            buf.close()
+
+        return summary_found, samples_found
 
     def get_data(self):
         """
@@ -198,16 +400,56 @@ class RowProCSV:
             'samples': self.samples,
         }
 
-    def get_tcx(self, sport=tcx.Activity.OTHER):
+    def clean(self, config=None):
+        """
+        Repair dropouts and outliers in the samples before conversion.
+        Interpolation needs the whole session, so on an instance created with load_samples=False
+        this reads all samples into memory and the instance behaves as loaded afterwards.
+        :param config: per-field settings merged into cleaning.DEFAULT_CONFIG
+        :type config: dict
+        """
+        samples = self.samples
+        if samples is None:
+            samples = [sample for chunk in self.iter_samples() for sample in chunk]
+        self.samples = cleaning.clean_samples(samples, config)
+
+    def get_analytics(self, **kwargs):
+        """
+        Return session analytics computed from the samples
+        Keyword arguments are passed to analytics.SessionAnalytics
+        If the samples were not loaded, they are streamed from the file and only the numeric
+        columns the analytics need are kept, not the samples themselves.
+        :rtype: analytics.SessionAnalytics
+        """
+        samples = self.samples
+        if samples is None:
+            samples = (sample for chunk in self.iter_samples() for sample in chunk)
+        return analytics.SessionAnalytics(samples, **kwargs)
+
+    def get_tcx(self, sport=tcx.Activity.OTHER, with_analytics=False, **kwargs):
         """
         Return a TCX instance constructed from the RowPro file
         :type sport: str
+        :param with_analytics: add session analytics as lap and activity extensions
+        :type with_analytics: bool
+        Other keyword arguments are passed to analytics.SessionAnalytics, e.g. max_hr to include heart rate zones
         :rtype: tcx.TCX
         """
-        track = tcx.Track()
-        for sample in self.samples:
-            tp = self.sample_to_trackpoint(self.date, sample)
-            track.add_point(tp)
+        if self.samples is None:
+            # samples were not loaded, create the trackpoints on demand each time the track is iterated
+            track = tcx.Track(point_source=self.iter_trackpoints)
+        else:
+            track = tcx.Track()
+            for sample in self.samples:
+                tp = self.sample_to_trackpoint(self.date, sample)
+                track.add_point(tp)
+
+        lap_extensions = []
+        activity_extensions = []
+        if with_analytics:
+            stats = self.get_analytics(**kwargs)
+            lap_extensions.append(stats.get_lap_extension())
+            activity_extensions.append(stats.get_activity_extension())
 
         lap = tcx.Lap(
             start_time=self.date,
@@ -215,8 +457,9 @@ class RowProCSV:
             distance=self.total_distance,
             avg_speed=self.avg_pace * 1000.0 / 60.0,   # kilometres per minute -> metres per second
             calories=self.total_cals,
-            avg_hr=self.avg_hr,
-            track=track
+            avg_hr=self.avg_hr or None,   # 0 means no heart rate reading
+            track=track,
+            extensions=lap_extensions
         )
 
         creator = {
@@ -229,7 +472,8 @@ class RowProCSV:
             time=self.date,
             sport=sport,
             lap=lap,
-            creator=creator
+            creator=creator,
+            extensions=activity_extensions
         )
 
         author = tcx.Author(__name__, version=__version__)
@@ -250,6 +494,6 @@ class RowProCSV:
             distance=sample['distance'],
             speed=sample['pace'] * 1000.0 / 60.0,   # kilometres per minute -> metres per second
             cadence=sample['spm'],
-            heart_rate=sample['hr'],
+            heart_rate=sample['hr'] or None,   # 0 means no heart rate reading
             power=sample['watts']
         )
@@ -1,6 +1,136 @@
+import datetime
 from lxml import etree
 
 
+def int_str(value):
+    """
+    Format a number rounded to an integer
+    :type value: float
+    :rtype: str
+    """
+    return str(int(round(value)))
+
+
+def float_formatter(digits):
+    """
+    Return a function formatting numbers with the given number of decimal digits
+    :type digits: int
+    :rtype: callable
+    """
+    if digits == 0:
+        return int_str
+    return '%.{}f'.format(digits).__mod__
+
+
+def time_formatter(digits):
+    """
+    Return a function formatting datetimes in ISO 8601 with the given number of fractional second digits
+    :type digits: int
+    :rtype: callable
+    """
+    step = 10 ** (6 - digits)
+
+    def format_time(value):
+        micro = int(round(value.microsecond / float(step))) * step
+        value = value.replace(microsecond=0) + datetime.timedelta(microseconds=micro)
+        text = value.isoformat()
+        if value.microsecond and digits < 6:
+            # isoformat always writes all 6 fractional digits
+            text = text[:20 + digits] + text[26:]
+        return text
+
+    return format_time
+
+
+class OutputProfile(object):
+    """
+    Settings for serialising TCX documents
+    :type name: str
+    :type precision: dict
+    :type omit_unchanged: list of str
+    :type hoist_namespaces: bool
+    :type formatters: dict
+    """
+    TIME_FIELDS = ['time']
+
+    name = None
+    precision = None
+    omit_unchanged = None
+    hoist_namespaces = False
+    formatters = None
+
+    def __init__(self, name, precision=None, omit_unchanged=None, hoist_namespaces=False):
+        """
+        :type name: str
+        :param precision: number of decimal digits (fractional second digits for times) by field name
+        :type precision: dict
+        :param omit_unchanged: trackpoint fields left out when their formatted value equals the previous point's
+        :type omit_unchanged: list of str
+        :param hoist_namespaces: declare namespaces only on the root element
+        :type hoist_namespaces: bool
+        """
+        self.name = name
+        self.precision = precision or {}
+        self.omit_unchanged = omit_unchanged or []
+        self.hoist_namespaces = hoist_namespaces
+        # formatters are built once per profile rather than per value
+        self.formatters = {}
+        for field, digits in self.precision.items():
+            if field in self.TIME_FIELDS:
+                self.formatters[field] = time_formatter(digits)
+            else:
+                self.formatters[field] = float_formatter(digits)
+
+
+PROFILES = {
+    'default': OutputProfile('default'),
+    'compact': OutputProfile(
+        'compact',
+        precision={
+            'time': 1,
+            'total_time': 1,
+            'distance': 1,
+            'altitude': 1,
+            'latitude': 7,
+            'longitude': 7,
+            'speed': 2,
+            'avg_speed': 2,
+            'max_speed': 2,
+            'power': 0,
+            'work': 0,
+        },
+        omit_unchanged=['altitude', 'heart_rate', 'cadence'],
+        hoist_namespaces=True
+    ),
+}
+
+
+def get_profile(profile):
+    """
+    Return the output profile given by name or instance
+    :type profile: str or OutputProfile or None
+    :rtype: OutputProfile or None
+    """
+    if isinstance(profile, basestring):
+        return PROFILES[profile]
+    return profile
+
+
+def format_field(profile, field, value, default=str):
+    """
+    Format a value using the profile formatter for the field, or the default function
+    :type profile: OutputProfile or None
+    :type field: str
+    :type default: callable
+    :rtype: str
+    """
+    if profile is not None:
+        formatter = profile.formatters.get(field)
+        if formatter is not None:
+            return formatter(value)
+    return default(value)
+
+
 class TCXBase(object):
 
     NS1 = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
@@ -11,31 +141,44 @@ class TCXBase(object):
     XSI = 'http://www.w3.org/2001/XMLSchema-instance'
 
     NSMAP = {None: NS1, 'ns2': NS2, 'ns3': NS3, 'ns4': NS4, 'ns5': NS5, 'xsi': XSI}
+    # namespaces used by the instance in addition to NSMAP, e.g. by extensions
+    EXTRA_NSMAP = {}
 
     def __init__(self):
         pass
 
-    def get_xml(self):
+    def get_nsmap(self):
+        """
+        Return the namespaces used by the instance and its children in addition to NSMAP
+        :rtype: dict
+        """
+        return dict(self.EXTRA_NSMAP)
+
+    def get_xml(self, profile=None):
         pass
 
-    def dumps(self, pretty_print=False):
+    def dumps(self, pretty_print=False, profile=None):
         """
         Return string representation of the XML subtree
         :type pretty_print: bool
+        :param profile: output profile or its name
+        :type profile: OutputProfile or str
         :rtype: str
         """
-        el = self.get_xml()
+        el = self.get_xml(get_profile(profile))
         return etree.tostring(el, encoding='UTF-8', xml_declaration=True, pretty_print=pretty_print)
 
-    def dump(self, filename, pretty_print=False):
+    def dump(self, filename, pretty_print=False, profile=None):
         """
         Write the string representation of the XML subtree to a file
         :type filename: str
         :type pretty_print: bool
+        :param profile: output profile or its name
+        :type profile: OutputProfile or str
         :return: True on success, False on failure
         :rtype: bool
         """
-        xml = self.dumps(pretty_print=pretty_print)
+        xml = self.dumps(pretty_print=pretty_print, profile=profile)
         try:
             with open(filename, 'w') as fp:
                 fp.write(xml)
@@ -45,6 +188,54 @@ class TCXBase(object):
 
         return True
 
+    @classmethod
+    def write_element(cls, xf, el, profile=None):
+        """
+        Write an element to an incremental XML writer.
+        Elements are written node by node, so they use the namespace declarations of the enclosing
+        elements instead of repeating them in every written subtree.
+        :type xf: etree.xmlfile
+        :type el: etree.Element
+        :type profile: OutputProfile
+        """
+        if not len(el) and not el.nsmap and not el.tag.startswith('{'):
+            # leaves without any namespace are written without declarations anyway
+            xf.write(el)
+            return
+
+        with xf.element(el.tag, attrib=dict(el.attrib)):
+            if el.text:
+                xf.write(el.text)
+            for child in el:
+                cls.write_element(xf, child, profile)
+
+    def write_xml(self, xf, profile=None):
+        """
+        Write the XML representation of the instance to an incremental XML writer
+        :type xf: etree.xmlfile
+        :type profile: OutputProfile
+        """
+        self.write_element(xf, self.get_xml(profile), profile)
+
+    def dump_incremental(self, filename, profile=None):
+        """
+        Write the XML subtree to a file element by element, without building the whole tree in memory
+        :type filename: str
+        :param profile: output profile or its name
+        :type profile: OutputProfile or str
+        :return: True on success, False on failure
+        :rtype: bool
+        """
+        try:
+            with etree.xmlfile(filename, encoding='UTF-8') as xf:
+                xf.write_declaration()
+                self.write_xml(xf, get_profile(profile))
+        except IOError as e:
+            print 'Cannot write to {}: {}'.format(filename, e)
+            return False
+
+        return True
+
 
 class TCX(TCXBase):
     """
@@ -60,10 +251,21 @@ class TCX(TCXBase):
         :type author: Author
         """
         super(TCX, self).__init__()
+        self.activities = []
         if activity is not None:
             self.add_activity(activity)
         self.author = author
 
+    def get_nsmap(self):
+        """
+        Return the namespaces used by the instance and its children in addition to NSMAP
+        :rtype: dict
+        """
+        nsmap = super(TCX, self).get_nsmap()
+        for activity in self.activities:
+            nsmap.update(activity.get_nsmap())
+        return nsmap
+
     def add_activity(self, activity):
         """
         Add an activity to the TCX file
@@ -71,25 +273,53 @@ class TCX(TCXBase):
         """
         self.activities.append(activity)
 
-    def get_xml(self):
+    def get_head_xml(self):
         """
-        Return an XML representation of the instance
+        Return the root element without any children
         :return: etree.Element
         """
-        root = etree.Element('TrainingCenterDatabase', nsmap=self.NSMAP)
+        nsmap = dict(self.NSMAP)
+        # declare the extension namespaces on the root too, so they keep their prefixes when streamed
+        nsmap.update(self.get_nsmap())
+        root = etree.Element('TrainingCenterDatabase', nsmap=nsmap)
         root.attrib['{{{}}}schemaLocation'.format(self.XSI)] = (
             'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2 '
             'http://www.garmin.com/xmlschemas/TrainingCenterDatabasev2.xsd'
         )
+
+        return root
+
+    def get_xml(self, profile=None):
+        """
+        Return an XML representation of the instance
+        :type profile: OutputProfile
+        :return: etree.Element
+        """
+        root = self.get_head_xml()
         activities = etree.SubElement(root, 'Activities')
         for activity in self.activities:
-            activities.append(activity.get_xml())
+            activities.append(activity.get_xml(profile))
 
         if self.author is not None:
-            root.append(self.author.get_xml())
+            root.append(self.author.get_xml(profile))
 
         return root
 
+    def write_xml(self, xf, profile=None):
+        """
+        Write the XML representation of the instance to an incremental XML writer
+        :type xf: etree.xmlfile
+        :type profile: OutputProfile
+        """
+        root = self.get_head_xml()
+        with xf.element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap):
+            with xf.element('Activities'):
+                for activity in self.activities:
+                    activity.write_xml(xf, profile)
+
+            if self.author is not None:
+                self.write_element(xf, self.author.get_xml(profile), profile)
+
 
 class Version(TCXBase):
     """
@@ -101,9 +331,10 @@ class Version(TCXBase):
         super(Version, self).__init__()
         self.version = version
 
-    def get_xml(self):
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Version', nsmap=self.NSMAP)
@@ -125,13 +356,14 @@ class Build(Version):
     def __init__(self, version):
         super(Build, self).__init__(version)
 
-    def get_xml(self):
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Build', nsmap=self.NSMAP)
-        root.append(super(Build, self).get_xml())
+        root.append(super(Build, self).get_xml(profile))
 
         return root
 
@@ -146,26 +378,33 @@ class Author(Build):
     lang = None
     part_number = None
 
+    # Build, LangID and PartNumber are required by the schema
+    DEFAULT_VERSION = '0.0'
+    DEFAULT_LANG = 'en'
+    DEFAULT_PART_NUMBER = '000-00000-00'
+
     def __init__(self, name, version=None, lang=None, part_number=None):
         super(Author, self).__init__(version)
         self.name = name
         self.lang = lang
         self.part_number = part_number
 
-    def get_xml(self):
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Author', nsmap=self.NSMAP)
         root.attrib['{{{}}}type'.format(self.XSI)] = 'Application_t'
         etree.SubElement(root, 'Name').text = self.name
         if self.version is not None:
-            root.append(super(Author, self).get_xml())
-        if self.lang is not None:
-            etree.SubElement(root, 'LangID').text = self.lang
-        if self.part_number is not None:
-            etree.SubElement(root, 'PartNumber').text = self.part_number
+            root.append(super(Author, self).get_xml(profile))
+        else:
+            root.append(Build(self.DEFAULT_VERSION).get_xml(profile))
+        etree.SubElement(root, 'LangID').text = self.lang if self.lang is not None else self.DEFAULT_LANG
+        etree.SubElement(root, 'PartNumber').text = \
+            self.part_number if self.part_number is not None else self.DEFAULT_PART_NUMBER
 
         return root
 
@@ -182,6 +421,11 @@ class Creator(TCXBase):
     product_id = None
     version = None
 
+    # UnitId, ProductID and Version are required by the schema
+    DEFAULT_UNIT_ID = '0'
+    DEFAULT_PRODUCT_ID = '0'
+    DEFAULT_VERSION = '0.0'
+
     def __init__(self, name, unit_id=None, product_id=None, version=None):
         super(Creator, self).__init__()
         self.name = name
@@ -189,20 +433,20 @@ class Creator(TCXBase):
         self.product_id = product_id
         self.version = version
 
-    def get_xml(self):
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Creator', nsmap=self.NSMAP)
         root.attrib['{{{}}}type'.format(self.XSI)] = 'Device_t'
         etree.SubElement(root, 'Name').text = self.name
-        if self.unit_id is not None:
-            etree.SubElement(root, 'UnitID').text = self.unit_id
-        if self.product_id is not None:
-            etree.SubElement(root, 'ProductID').text = self.product_id
-        if self.version is not None:
-            root.append(Version(self.version).get_xml())
+        etree.SubElement(root, 'UnitId').text = \
+            str(self.unit_id) if self.unit_id is not None else self.DEFAULT_UNIT_ID
+        etree.SubElement(root, 'ProductID').text = \
+            str(self.product_id) if self.product_id is not None else self.DEFAULT_PRODUCT_ID
+        root.append(Version(self.version if self.version is not None else self.DEFAULT_VERSION).get_xml(profile))
 
         return root
 
@@ -213,6 +457,7 @@ class Activity(TCXBase):
     :type sport: str
     :type laps: list of Lap
     :type creator: dict
+    :type extensions: list of TCXBase
     """
     RUNNING = 'Running'
     BIKING = 'Biking'
@@ -221,19 +466,33 @@ class Activity(TCXBase):
     sport = None
     laps = []
     creator = None
+    extensions = None
 
-    def __init__(self, time=None, sport=None, lap=None, creator={}):
+    def __init__(self, time=None, sport=None, lap=None, creator={}, extensions=None):
         """
         :param time: datetime.datetime
         :param sport: str
         :param lap: Lap
+        :param extensions: list of TCXBase
         """
         super(Activity, self).__init__()
         self.time = time
         self.sport = sport
+        self.laps = []
         if lap is not None:
             self.add_lap(lap)
         self.creator = creator
+        self.extensions = list(extensions) if extensions is not None else []
+
+    def get_nsmap(self):
+        """
+        Return the namespaces used by the instance and its children in addition to NSMAP
+        :rtype: dict
+        """
+        nsmap = super(Activity, self).get_nsmap()
+        for child in self.laps + self.extensions:
+            nsmap.update(child.get_nsmap())
+        return nsmap
 
     def add_lap(self, lap):
         """
@@ -242,26 +501,68 @@ class Activity(TCXBase):
         """
         self.laps.append(lap)
 
-    def get_xml(self):
+    def get_head_xml(self):
         """
-        Return an XML representation of the instance
+        Return the activity element with the children preceding the laps
         :return: etree.Element
         """
         root = etree.Element('Activity')
         root.attrib['Sport'] = self.sport
         id = etree.SubElement(root, 'Id')
         id.text = self.time.isoformat()
-        for lap in self.laps:
-            root.append(lap.get_xml())
 
+        return root
+
+    def get_tail_xml(self, profile=None):
+        """
+        Return the child elements following the laps
+        :type profile: OutputProfile
+        :return: list of etree.Element
+        """
+        tail = []
         if 'name' in self.creator or 'version' in self.creator or 'unit_id' in self.creator or \
                 'product_id' in self.creator:
-            root.append(Creator(name=self.creator.get('name'), unit_id=self.creator.get('unit_id'),
+            tail.append(Creator(name=self.creator.get('name'), unit_id=self.creator.get('unit_id'),
                                 product_id=self.creator.get('product_id'),
-                                version=self.creator.get('version')).get_xml())
+                                version=self.creator.get('version')).get_xml(profile))
+
+        if self.extensions:
+            ext = etree.Element('Extensions')
+            for extension in self.extensions:
+                ext.append(extension.get_xml(profile))
+            tail.append(ext)
+
+        return tail
+
+    def get_xml(self, profile=None):
+        """
+        Return an XML representation of the instance
+        :type profile: OutputProfile
+        :return: etree.Element
+        """
+        root = self.get_head_xml()
+        for lap in self.laps:
+            root.append(lap.get_xml(profile))
+        for el in self.get_tail_xml(profile):
+            root.append(el)
 
         return root
 
+    def write_xml(self, xf, profile=None):
+        """
+        Write the XML representation of the instance to an incremental XML writer
+        :type xf: etree.xmlfile
+        :type profile: OutputProfile
+        """
+        root = self.get_head_xml()
+        with xf.element(root.tag, attrib=dict(root.attrib)):
+            for el in root:
+                self.write_element(xf, el, profile)
+            for lap in self.laps:
+                lap.write_xml(xf, profile)
+            for el in self.get_tail_xml(profile):
+                self.write_element(xf, el, profile)
+
 
 class Lap(TCXBase):
     """
@@ -277,8 +578,14 @@ class Lap(TCXBase):
     :type avg_cadence: int
     :type max_cadence: int
     :type calories: float
+    :type intensity: str
+    :type trigger_method: str
     :type tracks: list of Track
+    :type extensions: list of TCXBase
     """
+    ACTIVE = 'Active'
+    RESTING = 'Resting'
+    MANUAL = 'Manual'
     start_time = None
     total_time = None
     distance = None
@@ -291,20 +598,28 @@ class Lap(TCXBase):
     avg_cadence = None
     max_cadence = None
     calories = None
+    intensity = None
+    trigger_method = None
     tracks = []
-
-    tags = {
-        'TotalTimeSeconds': {'src': 'total_time'},
-        'DistanceMeters': {'src': 'distance'},
-        'MaximumSpeed': {'src': 'max_speed'},
-        'AverageHeartRateBpm': {'src': 'avg_hr', 'sub_el': 'Value'},
-        'MaximumHeartRateBpm': {'src': 'max_hr', 'sub_el': 'Value'},
-        'Cadence': {'src': 'avg_cadence'},
-        'Calories': {'src': 'calories'},
-    }
+    extensions = None
+
+    # in the order required by the schema
+    tags = [
+        ('TotalTimeSeconds', {'src': 'total_time'}),
+        ('DistanceMeters', {'src': 'distance'}),
+        ('MaximumSpeed', {'src': 'max_speed'}),
+        ('Calories', {'src': 'calories'}),
+        ('AverageHeartRateBpm', {'src': 'avg_hr', 'sub_el': 'Value'}),
+        ('MaximumHeartRateBpm', {'src': 'max_hr', 'sub_el': 'Value'}),
+        ('Intensity', {'src': 'intensity'}),
+        ('Cadence', {'src': 'avg_cadence'}),
+        ('TriggerMethod', {'src': 'trigger_method'}),
+    ]
+    INT_TAGS = ['Calories', 'AverageHeartRateBpm', 'MaximumHeartRateBpm', 'Cadence']
 
     def __init__(self, start_time, total_time=None, distance=None, avg_speed=None, max_speed=None,
-                 avg_hr=None, max_hr=None, avg_cadence=None, calories=None, track=None):
+                 avg_hr=None, max_hr=None, avg_cadence=None, calories=None, track=None, extensions=None,
+                 intensity=ACTIVE, trigger_method=MANUAL):
         super(Lap, self).__init__()
         self.start_time = start_time
         self.total_time = total_time
@@ -315,8 +630,22 @@ class Lap(TCXBase):
         self.max_hr = max_hr
         self.avg_cadence = avg_cadence
         self.calories = calories
+        self.intensity = intensity
+        self.trigger_method = trigger_method
+        self.tracks = []
         if track is not None:
             self.add_track(track)
+        self.extensions = list(extensions) if extensions is not None else []
+
+    def get_nsmap(self):
+        """
+        Return the namespaces used by the instance and its children in addition to NSMAP
+        :rtype: dict
+        """
+        nsmap = super(Lap, self).get_nsmap()
+        for extension in self.extensions:
+            nsmap.update(extension.get_nsmap())
+        return nsmap
 
     def add_track(self, track):
         """
@@ -329,6 +658,12 @@ class Lap(TCXBase):
         """
         Calculate stats that were not provided by the user
         """
+        # heart rate of 0 means no reading, it is not a valid value in the schema
+        if self.avg_hr is not None and self.avg_hr <= 0:
+            self.avg_hr = None
+        if self.max_hr is not None and self.max_hr <= 0:
+            self.max_hr = None
+
         total_time = 0
         distance = 0
         max_spd = 0
@@ -342,7 +677,12 @@ class Lap(TCXBase):
         tot_cad = 0
         num_cad = 0
         for track in self.tracks:
-            for tp in track.points:
+            first_tp = None
+            last_tp = None
+            for tp in track.iter_points():
+                if first_tp is None:
+                    first_tp = tp
+                last_tp = tp
                 if tp.speed is not None and tp.speed > max_spd:
                     max_spd = tp.speed
                 if tp.heart_rate is not None:
@@ -364,8 +704,8 @@ class Lap(TCXBase):
                     tot_cad += tp.cadence
                     num_cad += 1
 
-            first_tp = track.points[0]
-            last_tp = track.points[-1]
+            if last_tp is None:
+                continue
             if last_tp.distance is not None:
                 distance += last_tp.distance
             total_time += (last_tp.time - first_tp.time).total_seconds()
@@ -386,66 +726,119 @@ class Lap(TCXBase):
             self.avg_cadence = tot_cad / num_cad
         self.max_cadence = max_cad if self.max_cadence is None and max_cad > 0 else self.max_cadence
 
-    def get_xml(self):
+    def get_head_xml(self, profile=None):
         """
-        Return an XML representation of the instance
+        Return the lap element with the children preceding the tracks
+        :type profile: OutputProfile
         :return: etree.Element
         """
         self.calculate_stats()
+        formatters = profile.formatters if profile is not None else {}
         root = etree.Element('Lap')
         root.attrib['StartTime'] = self.start_time.isoformat()
-        for tag_name in self.tags:
-            tag = self.tags[tag_name]
-            if getattr(self, tag['src'], None) is not None:
+        for tag_name, tag in self.tags:
+            value = getattr(self, tag['src'], None)
+            if value is not None:
                 el = etree.SubElement(root, tag_name)
                 if tag.get('sub_el') is not None:
                     value_el = etree.SubElement(el, tag.get('sub_el'))
                 else:
                     value_el = el
-                value_el.text = self.format_val(tag_name, getattr(self, tag['src']))
+                formatter = formatters.get(tag['src'])
+                value_el.text = formatter(value) if formatter is not None else self.format_val(tag_name, value)
 
-        # extensions
-        if self.avg_speed is not None or self.max_cadence is not None or \
-                self.avg_power is not None or self.max_power is not None:
-            ext = etree.SubElement(root, 'Extensions')
-            lx = etree.SubElement(ext, '{{{}}}LX'.format(self.NS3))
-            if self.avg_speed is not None:
-                avg_spd = etree.SubElement(lx, '{{{}}}AvgSpeed'.format(self.NS3))
-                avg_spd.text = str(self.avg_speed)
-            if self.avg_power is not None:
-                avg_pwr = etree.SubElement(lx, '{{{}}}AvgWatts'.format(self.NS3))
-                avg_pwr.text = str(self.avg_power)
-            if self.max_power is not None:
-                max_pwr = etree.SubElement(lx, '{{{}}}MaxWatts'.format(self.NS3))
-                max_pwr.text = str(self.max_power)
-            if self.max_cadence is not None:
-                max_cad = etree.SubElement(lx, '{{{}}}MaxBikeCadence'.format(self.NS3))
-                max_cad.text = str(self.max_cadence)
+        return root
 
+    def get_tail_xml(self, profile=None):
+        """
+        Return the child elements following the tracks
+        :type profile: OutputProfile
+        :return: list of etree.Element
+        """
+        tail = []
+        if self.avg_speed is not None or self.max_cadence is not None or \
+                self.avg_power is not None or self.max_power is not None or self.extensions:
+            ext = etree.Element('Extensions')
+            if self.avg_speed is not None or self.max_cadence is not None or \
+                    self.avg_power is not None or self.max_power is not None:
+                lx = etree.SubElement(ext, '{{{}}}LX'.format(self.NS3))
+                if self.avg_speed is not None:
+                    avg_spd = etree.SubElement(lx, '{{{}}}AvgSpeed'.format(self.NS3))
+                    avg_spd.text = format_field(profile, 'avg_speed', self.avg_speed)
+                if self.max_cadence is not None:
+                    max_cad = etree.SubElement(lx, '{{{}}}MaxBikeCadence'.format(self.NS3))
+                    max_cad.text = int_str(self.max_cadence)
+                if self.avg_power is not None:
+                    avg_pwr = etree.SubElement(lx, '{{{}}}AvgWatts'.format(self.NS3))
+                    avg_pwr.text = int_str(self.avg_power)
+                if self.max_power is not None:
+                    max_pwr = etree.SubElement(lx, '{{{}}}MaxWatts'.format(self.NS3))
+                    max_pwr.text = int_str(self.max_power)
+            for extension in self.extensions:
+                ext.append(extension.get_xml(profile))
+            tail.append(ext)
+
+        return tail
+
+    def get_xml(self, profile=None):
+        """
+        Return an XML representation of the instance
+        :type profile: OutputProfile
+        :return: etree.Element
+        """
+        root = self.get_head_xml(profile)
         for track in self.tracks:
-            root.append(track.get_xml())
+            root.append(track.get_xml(profile))
+        for el in self.get_tail_xml(profile):
+            root.append(el)
 
         return root
 
-    @staticmethod
-    def format_val(tag_name, value):
+    def write_xml(self, xf, profile=None):
+        """
+        Write the XML representation of the instance to an incremental XML writer
+        :type xf: etree.xmlfile
+        :type profile: OutputProfile
+        """
+        root = self.get_head_xml(profile)
+        with xf.element(root.tag, attrib=dict(root.attrib)):
+            for el in root:
+                self.write_element(xf, el, profile)
+            for track in self.tracks:
+                track.write_xml(xf, profile)
+            for el in self.get_tail_xml(profile):
+                self.write_element(xf, el, profile)
+
+    @classmethod
+    def format_val(cls, tag_name, value):
         """
         Format a value based on the XML tag
         :type tag_name: str
         :type value: str or datetime.datetime
         :return: str
         """
+        if tag_name in cls.INT_TAGS:
+            return int_str(value)
         return str(value)
 
 
 class Track(TCXBase):
     """
     :type points: list of Trackpoint
+    :type point_source: callable
     """
     points = []
+    point_source = None
 
-    def __init__(self):
+    def __init__(self, point_source=None):
+        """
+        :param point_source: callable returning a new iterator over the points each time it is called,
+            used instead of the points list so that the points don't have to be kept in memory
+        :type point_source: callable
+        """
         super(Track, self).__init__()
+        self.points = []
+        self.point_source = point_source
 
     def add_point(self, point):
         """
@@ -454,17 +847,50 @@ class Track(TCXBase):
         """
         self.points.append(point)
 
-    def get_xml(self):
+    def iter_points(self):
+        """
+        Return an iterator over the points of the track
+        :rtype: iterator of Trackpoint
+        """
+        if self.point_source is not None:
+            return self.point_source()
+        return iter(self.points)
+
+    @staticmethod
+    def get_previous(profile):
+        """
+        Return a new record of the previous point's values, None if the profile does not omit unchanged values
+        :type profile: OutputProfile
+        :rtype: dict or None
+        """
+        if profile is not None and profile.omit_unchanged:
+            return {}
+        return None
+
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Track')
-        for point in self.points:
-            root.append(point.get_xml())
+        previous = self.get_previous(profile)
+        for point in self.iter_points():
+            root.append(point.get_xml(profile, previous))
 
         return root
 
+    def write_xml(self, xf, profile=None):
+        """
+        Write the XML representation of the instance to an incremental XML writer
+        :type xf: etree.xmlfile
+        :type profile: OutputProfile
+        """
+        previous = self.get_previous(profile)
+        with xf.element('Track'):
+            for point in self.iter_points():
+                self.write_element(xf, point.get_xml(profile, previous), profile)
+
 
 class Position(TCXBase):
     """
@@ -479,14 +905,15 @@ class Position(TCXBase):
         self.latitude = latitude
         self.longitude = longitude
 
-    def get_xml(self):
+    def get_xml(self, profile=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
         :return: etree.Element
         """
         root = etree.Element('Position')
-        etree.SubElement(root, 'LatitudeDegrees').text = self.latitude
-        etree.SubElement(root, 'LongitudeDegrees').text = self.longitude
+        etree.SubElement(root, 'LatitudeDegrees').text = format_field(profile, 'latitude', self.latitude)
+        etree.SubElement(root, 'LongitudeDegrees').text = format_field(profile, 'longitude', self.longitude)
 
         return root
 
@@ -509,13 +936,15 @@ class Trackpoint(Position):
     speed = None
     power = None
 
-    tags = {
-        'Time': {'src': 'time'},
-        'DistanceMeters': {'src': 'distance'},
-        'AltitudeMeters': {'src': 'altitude'},
-        'Cadence': {'src': 'cadence'},
-        'HeartRateBpm': {'src': 'heart_rate', 'sub_el': 'Value'},
-    }
+    # in the order required by the schema, Position goes between Time and AltitudeMeters
+    tags = [
+        ('Time', {'src': 'time'}),
+        ('AltitudeMeters', {'src': 'altitude'}),
+        ('DistanceMeters', {'src': 'distance'}),
+        ('HeartRateBpm', {'src': 'heart_rate', 'sub_el': 'Value'}),
+        ('Cadence', {'src': 'cadence'}),
+    ]
+    INT_TAGS = ['HeartRateBpm', 'Cadence']
 
     def __init__(self, time=None, distance=None, latitude=None, longitude=None, altitude=None, cadence=None,
                  heart_rate=None, speed=None, power=None):
@@ -528,39 +957,74 @@ class Trackpoint(Position):
         self.speed = speed
         self.power = power
 
-    def get_xml(self):
+    def get_xml(self, profile=None, previous=None):
         """
         Return an XML representation of the instance
+        :type profile: OutputProfile
+        :param previous: formatted values of the previous point by field, updated in place;
+            fields listed in profile.omit_unchanged are left out when unchanged
+        :type previous: dict
         :return: etree.Element
         """
+        formatters = profile.formatters if profile is not None else {}
+        omit = profile.omit_unchanged if previous is not None else ()
         root = etree.Element('Trackpoint')
-        if self.latitude is not None and self.longitude is not None:
-            root.append(super(Trackpoint, self).get_xml())
-        for tag_name in self.tags:
-            tag = self.tags[tag_name]
-            if getattr(self, tag['src'], None) is not None:
+        for tag_name, tag in self.tags:
+            field = tag['src']
+            value = getattr(self, field, None)
+            if value is None and field in omit:
+                # a missing value breaks the run, the next value is written even if unchanged
+                previous.pop(field, None)
+            if value is not None:
+                formatter = formatters.get(field)
+                text = formatter(value) if formatter is not None else self.format_val(tag_name, value)
+                if field in omit:
+                    if previous.get(field) == text:
+                        continue
+                    previous[field] = text
                 el = etree.SubElement(root, tag_name)
                 if tag.get('sub_el') is not None:
                     value_el = etree.SubElement(el, tag.get('sub_el'))
                 else:
                     value_el = el
-                value_el.text = self.format_val(tag_name, getattr(self, tag['src']))
+                value_el.text = text
+            if tag_name == 'Time' and self.latitude is not None and self.longitude is not None:
+                root.append(super(Trackpoint, self).get_xml(profile))
 
         # add extensions
-        if self.speed is not None or self.power is not None:
-            ext = etree.SubElement(root, 'Extensions', nsmap=self.NSMAP)
+        speed = format_field(profile, 'speed', self.speed) if self.speed is not None else None
+        power = format_field(profile, 'power', self.power, int_str) if self.power is not None else None
+        if 'speed' in omit:
+            if speed is None:
+                previous.pop('speed', None)
+            elif previous.get('speed') == speed:
+                speed = None
+            else:
+                previous['speed'] = speed
+        if 'power' in omit:
+            if power is None:
+                previous.pop('power', None)
+            elif previous.get('power') == power:
+                power = None
+            else:
+                previous['power'] = power
+        if speed is not None or power is not None:
+            if profile is not None and profile.hoist_namespaces:
+                ext = etree.SubElement(root, 'Extensions')
+            else:
+                ext = etree.SubElement(root, 'Extensions', nsmap=self.NSMAP)
             tpx = etree.SubElement(ext, '{{{}}}TPX'.format(self.NS3))
-            if self.speed is not None:
+            if speed is not None:
                 spd = etree.SubElement(tpx, '{{{}}}Speed'.format(self.NS3))
-                spd.text = str(self.speed)
-            if self.power is not None:
+                spd.text = speed
+            if power is not None:
                 pwr = etree.SubElement(tpx, '{{{}}}Watts'.format(self.NS3))
-                pwr.text = str(self.power)
+                pwr.text = power
 
         return root
 
-    @staticmethod
-    def format_val(tag_name, value):
+    @classmethod
+    def format_val(cls, tag_name, value):
         """
         Format a value based on the XML tag
         :type tag_name: str
@@ -569,5 +1033,7 @@ class Trackpoint(Position):
         """
         if tag_name == 'Time':
             return value.isoformat()
+        elif tag_name in cls.INT_TAGS:
+            return int_str(value)
         else:
             return str(value)
@@ -0,0 +1,102 @@
+"""
+Module for validating generated TCX documents against the TrainingCenterDatabase v2 and
+ActivityExtension v2 schemas bundled in the schemas directory, so no network access is needed.
+"""
+
+import os
+from lxml import etree
+
+
+# import wrapper compiling both schemas together, so the activity extensions are validated strictly
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas', 'tcx.xsd')
+
+# compiled schema, loaded once per process
+_schema = None
+
+
+def get_schema():
+    """
+    Return the compiled TCX schema, compiling it on first use
+    :rtype: etree.XMLSchema
+    """
+    global _schema
+    if _schema is None:
+        _schema = etree.XMLSchema(etree.parse(SCHEMA_FILE))
+    return _schema
+
+
+def validate(xml):
+    """
+    Validate a TCX document and return the list of validation errors, empty if the document is valid.
+    Documents are always validated as serialised, elements and TCX instances are serialised and parsed back first.
+    :param xml: serialised document, an element or a TCX instance
+    :type xml: str or etree.Element or tcx.TCXBase
+    :rtype: list of str
+    """
+    if hasattr(xml, 'dumps'):
+        xml = xml.dumps()
+    elif etree.iselement(xml):
+        xml = etree.tostring(xml)
+
+    try:
+        doc = etree.fromstring(xml)
+    except etree.XMLSyntaxError as e:
+        return ['Malformed XML: {}'.format(e)]
+
+    schema = get_schema()
+    if schema.validate(doc):
+        return []
+    return ['line {}: {}'.format(error.line, error.message) for error in schema.error_log]
+
+
+def validate_file(filename):
+    """
+    Validate a TCX file and return the list of validation errors, empty if the file is valid
+    :type filename: str
+    :rtype: list of str
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            return validate(fp.read())
+    except IOError as e:
+        return ['Could not read file {}: {}'.format(filename, e)]
+
+
+class Validator(object):
+    """
+    Validator checking only every n-th document, so it can stay enabled for large batches
+    :type every: int
+    :type checked: int
+    :type failed: int
+    """
+    every = 1
+    seen = 0
+    checked = 0
+    failed = 0
+
+    def __init__(self, every=1):
+        """
+        :param every: validate one document out of every this many, 1 validates all of them
+        :type every: int
+        """
+        self.every = max(1, every)
+        self.seen = 0
+        self.checked = 0
+        self.failed = 0
+
+    def check(self, xml):
+        """
+        Validate the document if it is selected by the sampling
+        :type xml: str or etree.Element or tcx.TCXBase
+        :return: list of validation errors, None if the document was skipped
+        :rtype: list of str or None
+        """
+        self.seen += 1
+        if (self.seen - 1) % self.every:
+            return None
+
+        errors = validate(xml)
+        self.checked += 1
+        if errors:
+            self.failed += 1
+        return errors